@@ -1,12 +1,16 @@
 """
 Azure Functions HTTPトリガーでチャット機能を提供する。
+会話の履歴がある場合は、履歴を踏まえて質問を検索用に書き換える。
 質問の内容に関連する文章をAzure AI Searchで検索する。
+リランクを有効にした場合は、多めに取得した候補を並べ替え、上位だけを使う。
 質問と検索結果を元に、LLMで回答を作る。
 """
 
 import logging
 import os
 import json
+import math
+import time
 import asyncio
 import openai
 import azure.functions as func
@@ -14,7 +18,24 @@ from azurefunctions.extensions.http.fastapi import Request, StreamingResponse
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
 from azure.search.documents import SearchClient
 from azure.search.documents.models import VectorizedQuery
+from helpers.conversation import (
+    Conversation,
+    ConversationMemory,
+    ConversationStore,
+    format_turns,
+    parse_history,
+)
 from helpers.load_azd_env import load_azd_env
+from helpers.reranking import (
+    RERANKER_LEXICAL,
+    RERANKER_NONE,
+    RERANKER_SEMANTIC,
+    RERANKERS,
+    SEMANTIC_MIN_WAIT_MS,
+    arerank_lexical,
+)
+from helpers.search_filter import build_filter
+from helpers.throttling import Priority, ThrottledError, aoai_limiter
 
 logger = logging.getLogger(__name__)
 logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO").upper())
@@ -43,6 +64,18 @@ async def stream_processor(response):
                 yield delta.content
 
 
+async def stream_and_remember(response, conversation_id: str, conversation):
+    """
+    回答をストリームで返しながら集め、返し終えたら会話の履歴に加えて保管する。
+    """
+    answer = []
+    async for content in stream_processor(response):
+        answer.append(content)
+        yield content
+    conversation.turns.append({"role": "assistant", "content": "".join(answer)})
+    conversation_store.put(conversation_id, conversation)
+
+
 if os.getenv("AZURE_FUNCTIONS_ENVIRONMENT") == "Development":
     load_azd_env()
 
@@ -58,6 +91,41 @@ azure_openai_generative_model = check_env_var("AZURE_OPENAI_GENERATIVE_MODEL")
 azure_openai_embedding_model = check_env_var("AZURE_OPENAI_EMBEDDING_MODEL")
 search_service_name = check_env_var("AZURE_SEARCH_SERVICE_NAME")
 search_index_name = check_env_var("AZURE_SEARCH_INDEX_NAME")
+# フロントエンドのタイムアウト(30秒)より前に、混雑している旨を返す。
+# リクエスト全体(要約、書き換え、埋め込み、回答生成とそれぞれのリトライ)の期限とし、
+# 実行枠の待ちだけでなく、各呼び出しのタイムアウトにも残り時間を使う
+aoai_request_deadline_seconds = float(
+    os.getenv("AOAI_CHAT_DEADLINE_SECONDS", "20")
+)
+# 履歴の圧縮と質問の書き換えには、安価なモデルを指定できる
+azure_openai_rewrite_model = os.getenv(
+    "AZURE_OPENAI_REWRITE_MODEL", azure_openai_generative_model
+)
+# 会話が長くなってもプロンプトの大きさを一定に保つため、履歴のトークン数に上限を設ける
+history_recent_budget_tokens = int(os.getenv("HISTORY_RECENT_BUDGET_TOKENS", "800"))
+history_summary_max_tokens = int(os.getenv("HISTORY_SUMMARY_MAX_TOKENS", "300"))
+history_summary_input_budget_tokens = int(
+    os.getenv("HISTORY_SUMMARY_INPUT_BUDGET_TOKENS", "2000")
+)
+
+# リランク: none(無効)、lexical(CPUで動く語彙スコアラー)、semantic(AI Searchのセマンティックランカー)
+reranker = os.getenv("RERANKER", RERANKER_NONE)
+if reranker not in RERANKERS:
+    raise ValueError(f"RERANKER must be one of {', '.join(RERANKERS)}")
+rerank_candidates = int(os.getenv("RERANK_CANDIDATES", "50"))
+rerank_top = int(os.getenv("RERANK_TOP", "3"))
+rerank_budget_ms = int(os.getenv("RERANK_BUDGET_MS", "200"))
+semantic_configuration_name = os.getenv("AZURE_SEARCH_SEMANTIC_CONFIGURATION", "default")
+# セマンティックランカーの待ち時間には、AI Searchが受け付ける下限を設ける
+semantic_max_wait_ms = max(
+    SEMANTIC_MIN_WAIT_MS,
+    int(os.getenv("SEMANTIC_MAX_WAIT_MS", str(SEMANTIC_MIN_WAIT_MS))),
+)
+
+conversation_store = ConversationStore(
+    max_conversations=int(os.getenv("CONVERSATION_STORE_MAX", "1000")),
+    ttl_seconds=float(os.getenv("CONVERSATION_TTL_SECONDS", "3600")),
+)
 
 GROUNDED_PROMPT = """
 あなたは、提供された情報を基に、ユーザーの調査を支援するAIアシスタントです。
@@ -74,8 +142,12 @@ GROUNDED_PROMPT = """
 URLは文字列'[<URL>]'と整形して下さい。文字列'URL: 'は不要です。
 '['と']'を使うのはURLの整形だけにしてください。
 
+会話の要約と直近のやり取りがある場合は、質問の文脈として参照してください。
+
 以上です。
 
+会話の要約: {summary}
+直近のやり取り:\n{turns}
 質問: {query}
 情報源:\n{sources}
 """
@@ -109,21 +181,69 @@ async def chat(req: Request) -> StreamingResponse:
         )
 
     try:
-        openai_embedding_client = openai.AzureOpenAI(
+        search_filter = build_filter(req_body_json.get("filters"))
+    except ValueError as e:
+        return StreamingResponse(
+            iter([f"絞り込み条件が不正です: {e}"]),
+            media_type="text/event-stream",
+            status_code=400,
+        )
+
+    deadline = time.monotonic() + aoai_request_deadline_seconds
+
+    # 履歴はリクエストで渡すか、会話IDでサーバー側に保管したものを使う
+    conversation_id = None
+    try:
+        if req_body_json.get("history") is not None:
+            conversation = Conversation(
+                turns=parse_history(req_body_json.get("history"))
+            )
+        else:
+            conversation_id = req_body_json.get("conversation_id")
+            if conversation_id is not None and not isinstance(conversation_id, str):
+                raise ValueError("conversation_id must be a string")
+            conversation_id = conversation_id or ConversationStore.new_id()
+            conversation = conversation_store.get(conversation_id)
+    except ValueError as e:
+        return StreamingResponse(
+            iter([f"会話の履歴が不正です: {e}"]),
+            media_type="text/event-stream",
+            status_code=400,
+        )
+
+    try:
+        # 429と一時的なエラーのリトライはリミッターに任せるため、SDKのリトライは無効にする
+        openai_client = openai.AsyncAzureOpenAI(
             api_version=azure_openai_api_version,
             azure_endpoint=azure_openai_endpoint,
             azure_ad_token_provider=aoai_token_provider,
+            max_retries=0,
+        )
+
+        memory = ConversationMemory(
+            openai_client,
+            azure_openai_rewrite_model,
+            recent_budget_tokens=history_recent_budget_tokens,
+            summary_max_tokens=history_summary_max_tokens,
+            summary_input_budget_tokens=history_summary_input_budget_tokens,
+            deadline=deadline,
         )
+        conversation = await memory.compact(conversation)
+        search_query = await memory.rewrite_query(conversation, query)
 
-        response = openai_embedding_client.embeddings.create(
-            input=query, model=azure_openai_embedding_model
+        response = await aoai_limiter.acall(
+            openai_client.embeddings.create,
+            input=search_query,
+            model=azure_openai_embedding_model,
+            priority=Priority.CHAT,
+            deadline=deadline,
         )
 
         vector_query = VectorizedQuery(
             kind="vector",
             fields="text_vector",
             vector=response.data[0].embedding,
-            k_nearest_neighbors=3,
+            k_nearest_neighbors=3 if reranker == RERANKER_NONE else rerank_candidates,
         )
 
         search_client = SearchClient(
@@ -132,41 +252,87 @@ async def chat(req: Request) -> StreamingResponse:
             credential=credential,
         )
 
+        semantic_options = {}
+        if reranker == RERANKER_SEMANTIC:
+            # 待ち時間を超えた場合、AI Searchは一次検索の順位で結果を返す
+            semantic_options = {
+                "query_type": "semantic",
+                "semantic_configuration_name": semantic_configuration_name,
+                "semantic_max_wait_in_milliseconds": semantic_max_wait_ms,
+            }
+
         search_results = search_client.search(
-            search_text=query,
+            search_text=search_query,
             vector_queries=[vector_query],
             select=["title", "chunk", "url"],
-            top=5,
+            top=5 if reranker == RERANKER_NONE else rerank_candidates,
+            # 絞り込んだ範囲でベクトル検索し、候補を減らす
+            filter=search_filter,
+            vector_filter_mode="preFilter" if search_filter else None,
+            **semantic_options,
         )
+        documents = list(search_results)
+
+        if reranker == RERANKER_LEXICAL:
+            documents = await arerank_lexical(
+                search_query, documents, rerank_top, rerank_budget_ms / 1000
+            )
+        elif reranker == RERANKER_SEMANTIC:
+            documents = documents[:rerank_top]
 
         sources_formatted = "=================\n".join(
             [
                 f'ファイル名: {document["title"]}, 内容: {document["chunk"]}, URL: {document["url"]}'
-                for document in search_results
+                for document in documents
             ]
         )
 
-        openai_chat_client = openai.AsyncAzureOpenAI(
-            api_version=azure_openai_api_version,
-            azure_endpoint=azure_openai_endpoint,
-            azure_ad_token_provider=aoai_token_provider,
-        )
-
-        response = await openai_chat_client.chat.completions.create(
+        response = await aoai_limiter.acall(
+            openai_client.chat.completions.create,
             messages=[
                 {
                     "role": "user",
                     "content": GROUNDED_PROMPT.format(
-                        query=query, sources=sources_formatted
+                        summary=conversation.summary or "なし",
+                        turns=format_turns(conversation.turns),
+                        query=query,
+                        sources=sources_formatted,
                     ),
                 }
             ],
             model=azure_openai_generative_model,
             stream=True,
+            priority=Priority.CHAT,
+            deadline=deadline,
+        )
+
+        if conversation_id is None:
+            return StreamingResponse(
+                stream_processor(response), media_type="text/event-stream"
+            )
+
+        conversation.turns.append({"role": "user", "content": query})
+        return StreamingResponse(
+            stream_and_remember(response, conversation_id, conversation),
+            media_type="text/event-stream",
+            headers={"X-Conversation-Id": conversation_id},
         )
 
+    except ThrottledError as e:
+        logger.warning("Throttled: %s, stats: %s", e, aoai_limiter.stats())
         return StreamingResponse(
-            stream_processor(response), media_type="text/event-stream"
+            iter(["現在混み合っています。しばらくしてから再実行してください"]),
+            media_type="text/event-stream",
+            status_code=429,
+            headers={"Retry-After": str(math.ceil(e.retry_after))},
+        )
+
+    except openai.APITimeoutError as e:
+        logger.warning("Timed out within the request deadline: %s", e)
+        return StreamingResponse(
+            iter(["現在混み合っています。しばらくしてから再実行してください"]),
+            media_type="text/event-stream",
+            status_code=503,
         )
 
     except Exception as e:
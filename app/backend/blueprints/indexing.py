@@ -1,27 +1,30 @@
 """
 Azure Functions BlobトリガーでAzure AI SearchにRAG用インデックスを登録する。
 Blobの内容をDocument Intelligenceでレイアウト分析し、Markdownにする。
-MarkdownはLangChainのスプリッターでチャンクに分割し、Azure AI Searchへ登録する。
+Markdownは見出しと日本語の文境界を考慮し、トークン数に基づいてチャンクに分割する。
+チャンクはベクトル埋め込みし、Azure AI Searchへ登録する。
 """
 
 import logging
 import os
-import re
-import base64
 import openai
 import azure.functions as func
 from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+from azure.storage.blob import BlobClient
 from azure.search.documents import SearchClient
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.ai.documentintelligence.models import (
     AnalyzeDocumentRequest,
     AnalyzeResult,
 )
-from langchain.text_splitter import (
-    MarkdownHeaderTextSplitter,
-    RecursiveCharacterTextSplitter,
+from helpers.indexing_pipeline import (
+    LAYOUT_MODEL_ID,
+    build_search_document,
+    create_chunker,
+    to_uploaded_at,
 )
 from helpers.load_azd_env import load_azd_env
+from helpers.throttling import Priority, aoai_limiter
 
 logger = logging.getLogger(__name__)
 logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO").upper())
@@ -56,9 +59,27 @@ search_index_name = check_env_var("AZURE_SEARCH_INDEX_NAME")
 doc_intelligence_endpoint = check_env_var("AZURE_DOC_INTELLIGENCE_ENDPOINT")
 rag_blob_container_name = check_env_var("RAG_BLOB_CONTAINER_NAME")
 
+# チャンカーは使い回す。トークナイザーは最初のBlobでトークン数を数えるときに1回だけ読み込み、
+# 読み込めない場合は警告を出して文字数からの見積もりを使う
+chunker = create_chunker()
+
 bp_indexing = func.Blueprint()
 
 
+def get_uploaded_at(blob: func.InputStream) -> str:
+    """
+    Blobの最終更新日時をアップロード日時として返す。
+    リトライや既存Blobの一括処理もあるため、トリガーの実行時刻は使わない。
+    トリガーのメタデータにない場合は、Blobのプロパティを取得する。
+    """
+    last_modified = (blob.blob_properties or {}).get("LastModified")
+    if last_modified:
+        return to_uploaded_at(last_modified)
+
+    blob_client = BlobClient.from_blob_url(blob.uri, credential=credential)
+    return to_uploaded_at(blob_client.get_blob_properties().last_modified)
+
+
 @bp_indexing.blob_trigger(
     arg_name="blob",
     path=f"{rag_blob_container_name}/{{name}}",
@@ -81,32 +102,18 @@ def indexing(blob: func.InputStream):
             endpoint=doc_intelligence_endpoint, credential=credential
         )
         poller = document_intelligence_client.begin_analyze_document(
-            "prebuilt-layout", AnalyzeDocumentRequest(bytes_source=blob_content)
+            LAYOUT_MODEL_ID, AnalyzeDocumentRequest(bytes_source=blob_content)
         )
         di_result: AnalyzeResult = poller.result()
 
-        headers_to_split_on = [
-            ("#", "Header 1"),
-            ("##", "Header 2"),
-            ("###", "Header 3"),
-        ]
-        markdown_splitter = MarkdownHeaderTextSplitter(
-            headers_to_split_on=headers_to_split_on
-        )
-
-        docs_string = di_result.content
-        markdown_chunks = markdown_splitter.split_text(docs_string)
-
-        recursive_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=2000, chunk_overlap=100
-        )
-
-        final_chunks = recursive_splitter.split_documents(markdown_chunks)
+        final_chunks = chunker.split(di_result.content)
 
+        # 429と一時的なエラーのリトライはリミッターに任せるため、SDKのリトライは無効にする
         openai_client = openai.AzureOpenAI(
             api_version=azure_openai_api_version,
             azure_endpoint=azure_openai_endpoint,
             azure_ad_token_provider=aoai_token_provider,
+            max_retries=0,
         )
 
         search_client = SearchClient(
@@ -115,25 +122,21 @@ def indexing(blob: func.InputStream):
             credential=credential,
         )
 
-        for i, split in enumerate(final_chunks):
-            response = openai_client.embeddings.create(
-                input=split.page_content, model=azure_openai_embedding_model
+        uploaded_at = get_uploaded_at(blob)
+
+        for i, chunk in enumerate(final_chunks):
+            # チャットの待ちがある間は実行枠を譲る
+            response = aoai_limiter.call(
+                openai_client.embeddings.create,
+                input=chunk.content,
+                model=azure_openai_embedding_model,
+                priority=Priority.INDEXING,
             )
             embeddings = response.data[0].embedding
 
-            filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", blob.name)
-            filename_hash = base64.b16encode(blob.name.encode("utf-8")).decode("ascii")
-            filename_converted = f"file-{filename_ascii}-{filename_hash}"
-            filename_base = blob.name.split("/")[-1]
-
-            document = {
-                "parent_id": filename_converted,
-                "title": filename_base,
-                "url": blob.uri,
-                "chunk_id": f"{filename_converted}{i}",
-                "chunk": split.page_content,
-                "text_vector": embeddings,
-            }
+            document = build_search_document(
+                blob.name, blob.uri, i, chunk, embeddings, uploaded_at
+            )
 
             result = search_client.upload_documents(documents=[document])
             if result[0].succeeded:
@@ -0,0 +1,214 @@
+"""
+Markdownを日本語の文境界とトークン数に基づいてチャンクに分割する。
+
+見出し(#, ##, ###)で区切りながら、1回の走査で文を積み上げてチャンクを作る。
+見出しの階層はチャンクのメタデータとして付与する。
+"""
+
+import functools
+import io
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from typing import Callable, Iterable, Iterator, Union
+import tiktoken
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO").upper())
+
+HEADERS_TO_SPLIT_ON = (
+    ("#", "Header 1"),
+    ("##", "Header 2"),
+    ("###", "Header 3"),
+)
+# アプリケーションに同梱したエンコーディングファイルの置き場所。
+# tiktokenは初回にインターネットからダウンロードするため、プライベートネットワークでは同梱したものを使う
+BUNDLED_TIKTOKEN_CACHE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tiktoken_cache"
+)
+
+_HEADER_LEVELS = {name: len(prefix) for prefix, name in HEADERS_TO_SPLIT_ON}
+
+_HEADER_PATTERN = re.compile(r"^(#{1,3})[ \t]+(.+?)[ \t#]*$")
+_FENCE_PATTERN = re.compile(r"^[ \t]*(```|~~~)")
+# 句点などで終わる文と、終端記号のない残りを取り出す。閉じ括弧は直前の文に含める
+_SENTENCE_PATTERN = re.compile(r"[^。！？]*[。！？]+[」』）)]*|[^。！？]+")
+
+
+def get_encoding(encoding_name: str = "cl100k_base") -> tiktoken.Encoding:
+    """
+    tiktokenのエンコーディングを読み込む。
+    TIKTOKEN_CACHE_DIRが未設定で、同梱のディレクトリがある場合はそれを使う。
+    """
+    if os.path.isdir(BUNDLED_TIKTOKEN_CACHE_DIR):
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", BUNDLED_TIKTOKEN_CACHE_DIR)
+    return tiktoken.get_encoding(encoding_name)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    文字数からトークン数を見積もる。エンコーディングを読み込めない場合に使う。
+    上限を超えないよう多めに見積もり、ASCII以外は1文字1トークン、ASCIIは3文字で1トークンとする。
+    """
+    ascii_chars = sum(1 for c in text if c.isascii())
+    return len(text) - ascii_chars + math.ceil(ascii_chars / 3)
+
+
+@functools.lru_cache(maxsize=None)
+def get_token_counter(encoding_name: str = "cl100k_base") -> Callable[[str], int]:
+    """
+    トークン数を数える関数を返す。エンコーディングは初回に1回だけ読み込む。
+    プライベートネットワークでダウンロードできないなど、読み込めない場合は警告を出し、
+    処理を止めずに文字数からの見積もりを使う。
+    """
+    try:
+        encoding = get_encoding(encoding_name)
+    except Exception as e:
+        logger.warning(
+            "Failed to load tiktoken encoding %s: %s. "
+            "Estimating token counts from characters. "
+            "Bundle the encoding in tiktoken_cache or set TIKTOKEN_CACHE_DIR",
+            encoding_name,
+            e,
+        )
+        return estimate_tokens
+    return lambda text: len(encoding.encode_ordinary(text))
+
+
+@dataclass
+class Chunk:
+    """
+    分割したチャンク。metadataには見出しの階層が入る。
+    """
+
+    content: str
+    token_count: int
+    metadata: dict = field(default_factory=dict)
+
+
+class JapaneseMarkdownChunker:
+    """
+    見出しを考慮し、日本語の文境界でMarkdownを分割するチャンカー。
+    チャンクの大きさはトークン数で決める。
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = 1000,
+        overlap_tokens: int = 50,
+        encoding_name: str = "cl100k_base",
+    ):
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens must be smaller than max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self._encoding_name = encoding_name
+
+    def count_tokens(self, text: str) -> int:
+        """
+        トークン数を数える。
+        tiktokenは初回にエンコーディングをダウンロードするため、読み込みは最初に数えるときまで遅らせる。
+        """
+        return get_token_counter(self._encoding_name)(text)
+
+    def split(self, markdown: Union[str, Iterable[str]]) -> Iterator[Chunk]:
+        """
+        Markdownをチャンクに分割する。文字列のほか、行のイテラブルも受け付ける。
+        """
+        lines = io.StringIO(markdown) if isinstance(markdown, str) else markdown
+        headers: dict = {}
+        sentences: list = []
+        total_tokens = 0
+        # 前のチャンクから引き継いだ文の数。引き継いだ文だけのチャンクは作らない
+        carried = 0
+        in_code_block = False
+
+        for line in lines:
+            if _FENCE_PATTERN.match(line):
+                in_code_block = not in_code_block
+
+            header = None if in_code_block else _HEADER_PATTERN.match(line.rstrip())
+            if header:
+                yield from self._emit(sentences, headers, carried)
+                sentences, total_tokens, carried = [], 0, 0
+                level = len(header.group(1))
+                headers = {
+                    name: value
+                    for name, value in headers.items()
+                    if _HEADER_LEVELS[name] < level
+                }
+                headers[HEADERS_TO_SPLIT_ON[level - 1][1]] = header.group(2)
+                continue
+
+            # コードブロックは文に分けず、行単位で扱う
+            units = [line] if in_code_block else _SENTENCE_PATTERN.findall(line)
+            for unit in units:
+                tokens = self.count_tokens(unit)
+                if tokens > self.max_tokens:
+                    yield from self._emit(sentences, headers, carried)
+                    sentences, total_tokens, carried = [], 0, 0
+                    yield from self._split_long_sentence(unit, tokens, headers)
+                    continue
+
+                if total_tokens + tokens > self.max_tokens:
+                    yield from self._emit(sentences, headers, carried)
+                    # 引き継ぐ文と次の文を合わせても上限を超えないようにする
+                    sentences = self._overlap(
+                        sentences, min(self.overlap_tokens, self.max_tokens - tokens)
+                    )
+                    total_tokens = sum(t for _, t in sentences)
+                    carried = len(sentences)
+
+                sentences.append((unit, tokens))
+                total_tokens += tokens
+
+        yield from self._emit(sentences, headers, carried)
+
+    def _emit(self, sentences: list, headers: dict, carried: int) -> Iterator[Chunk]:
+        if not "".join(s for s, _ in sentences[carried:]).strip():
+            return
+        content = "".join(s for s, _ in sentences).strip()
+        if content:
+            yield Chunk(
+                content=content,
+                token_count=sum(t for _, t in sentences),
+                metadata=dict(headers),
+            )
+
+    @staticmethod
+    def _overlap(sentences: list, budget_tokens: int) -> list:
+        """
+        次のチャンクに引き継ぐ、末尾の文を予算内で選ぶ。
+        """
+        kept: list = []
+        tokens = 0
+        for sentence, count in reversed(sentences):
+            if tokens + count > budget_tokens:
+                break
+            kept.append((sentence, count))
+            tokens += count
+        kept.reverse()
+        return kept
+
+    def _split_long_sentence(
+        self, sentence: str, tokens: int, headers: dict
+    ) -> Iterator[Chunk]:
+        """
+        上限を超える文を、文字数の比率で分割する。
+        トークン単位で切るとマルチバイト文字が壊れることがあるため、文字単位で切る。
+        """
+        step = max(1, len(sentence) * self.max_tokens // tokens)
+        start = 0
+        while start < len(sentence):
+            piece = sentence[start : start + step]
+            count = self.count_tokens(piece)
+            while count > self.max_tokens and len(piece) > 1:
+                piece = piece[: len(piece) * 9 // 10]
+                count = self.count_tokens(piece)
+            start += len(piece)
+            if piece.strip():
+                yield Chunk(
+                    content=piece.strip(), token_count=count, metadata=dict(headers)
+                )
@@ -0,0 +1,256 @@
+"""
+複数ターンのチャットのため、会話の履歴を一定の大きさに保つ。
+
+- 直近のやり取りはトークン数の予算内で残し、あふれた分はLLMで要約に畳み込む
+- 要約と直近のやり取りを踏まえ、検索前に質問を単独で意味が通じる形に書き換える
+- 会話IDで参照する履歴は、件数と有効期限に上限のあるインメモリのストアに保管する
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+from helpers.chunking import get_token_counter
+from helpers.throttling import Priority, aoai_limiter
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO").upper())
+
+ROLES = ("user", "assistant")
+# 1回の発言が極端に長い場合に備え、要約や書き換えに渡す前に切り詰める
+MAX_TURN_CHARS = 2000
+
+SUMMARY_PROMPT = """
+以下は、ユーザーとAIアシスタントの会話のこれまでの要約と、その後のやり取りです。
+両方を統合し、今後の質問の文脈として必要な事実、話題、固有名詞を残した要約を作成してください。
+要約は{max_tokens}トークン以内で、要約の本文だけを出力してください。
+
+これまでの要約:
+{summary}
+
+その後のやり取り:
+{turns}
+"""
+
+REWRITE_PROMPT = """
+以下の会話の要約と直近のやり取りを踏まえ、最後の質問を、会話を読まなくても意味が通じる検索用の質問に書き換えてください。
+指示語や省略を補い、書き換えた質問だけを1行で出力してください。
+書き換える必要がない場合は、質問をそのまま出力してください。
+
+会話の要約:
+{summary}
+
+直近のやり取り:
+{turns}
+
+最後の質問: {query}
+"""
+
+
+def count_tokens(text: str) -> int:
+    """
+    トークン数を数える。エンコーディングは初回に読み込み、読み込めない場合は文字数から見積もる。
+    """
+    return get_token_counter()(text)
+
+
+@dataclass
+class Conversation:
+    """
+    会話の状態。summaryに古いやり取りの要約、turnsに直近のやり取りを持つ。
+    """
+
+    summary: str = ""
+    turns: list = field(default_factory=list)
+
+    def is_empty(self) -> bool:
+        """
+        履歴がないかを返す。
+        """
+        return not self.summary and not self.turns
+
+
+def parse_history(history) -> list:
+    """
+    リクエストで渡された履歴を検証し、発言のリストにする。
+    """
+    if not isinstance(history, list):
+        raise ValueError("history must be a list")
+    turns = []
+    for turn in history:
+        if (
+            not isinstance(turn, dict)
+            or turn.get("role") not in ROLES
+            or not isinstance(turn.get("content"), str)
+        ):
+            raise ValueError(
+                "each history item must have role (user or assistant) and content"
+            )
+        turns.append({"role": turn["role"], "content": turn["content"]})
+    return turns
+
+
+def format_turns(turns: list) -> str:
+    """
+    発言をプロンプト用の文字列にする。
+    """
+    if not turns:
+        return "なし"
+    labels = {"user": "ユーザー", "assistant": "アシスタント"}
+    return "\n".join(
+        f'{labels[turn["role"]]}: {turn["content"][:MAX_TURN_CHARS]}' for turn in turns
+    )
+
+
+def split_recent(turns: list, budget_tokens: int) -> tuple:
+    """
+    新しい発言から予算内に収まる分を残す。(あふれた発言, 残す発言)を返す。
+    最新の発言は予算を超えていても残す。発言はMAX_TURN_CHARSで切り詰めるため、大きさには上限がある。
+    """
+    total = 0
+    start = len(turns)
+    for i in range(len(turns) - 1, -1, -1):
+        total += count_tokens(turns[i]["content"][:MAX_TURN_CHARS])
+        if total > budget_tokens and start < len(turns):
+            break
+        start = i
+    return turns[:start], turns[start:]
+
+
+class ConversationMemory:
+    """
+    会話の履歴を予算内に圧縮し、検索用に質問を書き換える。
+    LLMの呼び出しはチャットの優先度でリミッターを通す。
+    """
+
+    def __init__(
+        self,
+        client,
+        model: str,
+        recent_budget_tokens: int = 800,
+        summary_max_tokens: int = 300,
+        summary_input_budget_tokens: int = 2000,
+        deadline: Optional[float] = None,
+    ):
+        self._client = client
+        self._model = model
+        self._recent_budget_tokens = recent_budget_tokens
+        self._summary_max_tokens = summary_max_tokens
+        self._summary_input_budget_tokens = summary_input_budget_tokens
+        self._deadline = deadline
+
+    async def _complete(self, prompt: str, max_tokens: int) -> str:
+        response = await aoai_limiter.acall(
+            self._client.chat.completions.create,
+            messages=[{"role": "user", "content": prompt}],
+            model=self._model,
+            max_tokens=max_tokens,
+            temperature=0,
+            priority=Priority.CHAT,
+            deadline=self._deadline,
+        )
+        return (response.choices[0].message.content or "").strip()
+
+    async def compact(self, conversation: Conversation) -> Conversation:
+        """
+        予算からあふれた発言を要約に畳み込み、新しい会話の状態を返す。
+        """
+        overflow, recent = split_recent(
+            conversation.turns, self._recent_budget_tokens
+        )
+        if not overflow:
+            return conversation
+
+        # 要約のプロンプトを一定の大きさに保つため、要約に渡す発言にも上限を設ける。
+        # 履歴をリクエストで渡す場合は要約を保管しないため、上限を超えた古い発言は捨てる
+        dropped, overflow = split_recent(overflow, self._summary_input_budget_tokens)
+        if dropped:
+            logger.debug("Dropped %d old turns beyond summary input budget", len(dropped))
+
+        summary = await self._complete(
+            SUMMARY_PROMPT.format(
+                max_tokens=self._summary_max_tokens,
+                summary=conversation.summary or "なし",
+                turns=format_turns(overflow),
+            ),
+            self._summary_max_tokens,
+        )
+        logger.debug("Compacted %d turns into summary", len(overflow))
+        return Conversation(summary=summary, turns=recent)
+
+    async def rewrite_query(self, conversation: Conversation, query: str) -> str:
+        """
+        会話の文脈を踏まえ、検索用の質問を作る。履歴がない場合はそのまま返す。
+        """
+        if conversation.is_empty():
+            return query
+        rewritten = await self._complete(
+            REWRITE_PROMPT.format(
+                summary=conversation.summary or "なし",
+                turns=format_turns(conversation.turns),
+                query=query,
+            ),
+            # 書き換えた質問は元の質問と同程度の長さで足りる
+            max(64, count_tokens(query) * 2),
+        )
+        logger.debug("Rewrote query: %s -> %s", query, rewritten)
+        return rewritten or query
+
+
+class ConversationStore:
+    """
+    会話IDごとに会話の状態を保管する。
+    件数が上限を超えたら最も古く使われた会話から捨て、有効期限を過ぎた会話も捨てる。
+    インスタンス間では共有しない。
+    """
+
+    def __init__(self, max_conversations: int = 1000, ttl_seconds: float = 3600):
+        self._max_conversations = max_conversations
+        self._ttl_seconds = ttl_seconds
+        self._conversations: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def new_id() -> str:
+        """
+        新しい会話IDを作る。
+        """
+        return uuid.uuid4().hex
+
+    def get(self, conversation_id: str) -> Conversation:
+        """
+        会話の状態を返す。ない場合や期限切れの場合は空の会話を返す。
+        """
+        with self._lock:
+            entry = self._conversations.get(conversation_id)
+            if entry is None:
+                return Conversation()
+            updated_at, conversation = entry
+            if time.monotonic() - updated_at > self._ttl_seconds:
+                del self._conversations[conversation_id]
+                return Conversation()
+            self._conversations.move_to_end(conversation_id)
+            return Conversation(
+                summary=conversation.summary, turns=list(conversation.turns)
+            )
+
+    def put(self, conversation_id: str, conversation: Conversation):
+        """
+        会話の状態を保管する。
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._conversations[conversation_id] = (now, conversation)
+            self._conversations.move_to_end(conversation_id)
+            while self._conversations:
+                oldest_id, (updated_at, _) = next(iter(self._conversations.items()))
+                if (
+                    len(self._conversations) <= self._max_conversations
+                    and now - updated_at <= self._ttl_seconds
+                ):
+                    break
+                del self._conversations[oldest_id]
@@ -0,0 +1,87 @@
+"""
+インデクシングの処理のうち、BlobトリガーとバルクインデクシングCLIで共通の部分。
+
+- レイアウト分析のモデル
+- チャンカーの設定
+- Azure AI Searchに登録するドキュメントの組み立て
+"""
+
+import base64
+import os
+import re
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Union
+from helpers.chunking import Chunk, JapaneseMarkdownChunker
+
+LAYOUT_MODEL_ID = "prebuilt-layout"
+
+
+def create_chunker() -> JapaneseMarkdownChunker:
+    """
+    環境変数の設定でチャンカーを作る。
+    """
+    return JapaneseMarkdownChunker(
+        max_tokens=int(os.getenv("CHUNK_MAX_TOKENS", "1000")),
+        overlap_tokens=int(os.getenv("CHUNK_OVERLAP_TOKENS", "50")),
+    )
+
+
+def to_parent_id(name: str) -> str:
+    """
+    ファイル名から、インデックスのキーに使える親ドキュメントIDを作る。
+    nameはBlobトリガーと同じく、"<コンテナー名>/<Blob名>"の形式。
+    """
+    filename_ascii = re.sub("[^0-9a-zA-Z_-]", "_", name)
+    filename_hash = base64.b16encode(name.encode("utf-8")).decode("ascii")
+    return f"file-{filename_ascii}-{filename_hash}"
+
+
+def to_uploaded_at(last_modified: Union[datetime, str]) -> str:
+    """
+    Blobの最終更新日時(ファイルの場合は更新日時)を、インデックスのuploaded_at用にUTCのISO 8601形式にする。
+    Blobトリガーのメタデータでは文字列(ISO 8601またはRFC 1123)、SDKではdatetimeで得られるため、
+    どちらも受け付ける。
+    """
+    if isinstance(last_modified, str):
+        try:
+            last_modified = datetime.fromisoformat(last_modified.replace("Z", "+00:00"))
+        except ValueError:
+            last_modified = parsedate_to_datetime(last_modified)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified.astimezone(timezone.utc).isoformat()
+
+
+def get_doc_type(name: str) -> str:
+    """
+    拡張子からドキュメントの種類を返す。
+    """
+    return os.path.splitext(name)[1].lstrip(".").lower()
+
+
+def build_search_document(
+    name: str,
+    url: str,
+    index: int,
+    chunk: Chunk,
+    embedding: list,
+    uploaded_at: str,
+) -> dict:
+    """
+    チャンクとベクトルから、Azure AI Searchに登録するドキュメントを組み立てる。
+    """
+    parent_id = to_parent_id(name)
+    return {
+        "parent_id": parent_id,
+        "title": name.split("/")[-1],
+        "url": url,
+        "chunk_id": f"{parent_id}{index}",
+        "chunk": chunk.content,
+        "header_1": chunk.metadata.get("Header 1"),
+        "header_2": chunk.metadata.get("Header 2"),
+        "header_3": chunk.metadata.get("Header 3"),
+        "doc_type": get_doc_type(name),
+        "uploaded_at": uploaded_at,
+        "text_vector": embedding,
+    }
@@ -0,0 +1,148 @@
+"""
+検索結果の候補を並べ替え(リランク)、上位の文章だけをLLMに渡す。
+
+CPUで動く軽量な語彙スコアラーを使う。日本語は分かち書きせず、文字バイグラムのBM25で評価し、
+一次検索の順位と逆順位融合(RRF)で組み合わせる。
+時間の予算を超えた場合は、一次検索の順位をそのまま使う。
+"""
+
+import asyncio
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO").upper())
+
+RERANKER_NONE = "none"
+RERANKER_LEXICAL = "lexical"
+RERANKER_SEMANTIC = "semantic"
+RERANKERS = (RERANKER_NONE, RERANKER_LEXICAL, RERANKER_SEMANTIC)
+# セマンティックランカーの待ち時間は、700ミリ秒未満だとAI Searchがエラーにする
+SEMANTIC_MIN_WAIT_MS = 700
+
+# 記号や空白は語彙の一致に寄与しないため除く
+_NOISE_PATTERN = re.compile(r"[\s\W_]+")
+
+
+class BudgetExceededError(Exception):
+    """
+    リランクが時間の予算を超えた場合の例外。
+    """
+
+
+def _bigrams(text: str) -> list:
+    text = _NOISE_PATTERN.sub(" ", text.lower())
+    grams = []
+    for word in text.split():
+        if len(word) == 1:
+            grams.append(word)
+        else:
+            grams.extend(word[i : i + 2] for i in range(len(word) - 1))
+    return grams
+
+
+def lexical_scores(
+    query: str,
+    passages: list,
+    deadline: Optional[float] = None,
+    k1: float = 1.2,
+    b: float = 0.75,
+) -> list:
+    """
+    候補の集合を文書集合とみなし、質問に対する文字バイグラムのBM25スコアを返す。
+    deadline(time.monotonicの値)を過ぎたらBudgetExceededErrorにする。
+    """
+    query_terms = set(_bigrams(query))
+    if not query_terms or not passages:
+        return [0.0] * len(passages)
+
+    term_counts = []
+    for passage in passages:
+        if deadline is not None and time.monotonic() > deadline:
+            raise BudgetExceededError()
+        term_counts.append(Counter(_bigrams(passage)))
+
+    lengths = [sum(counts.values()) for counts in term_counts]
+    average_length = sum(lengths) / len(lengths) or 1.0
+    document_frequency = {
+        term: sum(1 for counts in term_counts if term in counts)
+        for term in query_terms
+    }
+    n = len(passages)
+
+    scores = []
+    for counts, length in zip(term_counts, lengths):
+        score = 0.0
+        for term in query_terms:
+            tf = counts.get(term, 0)
+            if not tf:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = k1 * (1 - b + b * length / average_length)
+            score += idf * tf * (k1 + 1) / (tf + norm)
+        scores.append(score)
+    return scores
+
+
+def fuse_ranks(
+    first_stage_count: int, scores: list, weight: float = 1.5, k: int = 10
+) -> list:
+    """
+    一次検索の順位とスコアによる順位を逆順位融合し、候補の添字を良い順に返す。
+    候補は数十件と少ないため、kを小さくして順位の差が効くようにする。
+    """
+    by_score = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)
+    fused = [1 / (k + i + 1) for i in range(first_stage_count)]
+    for rank, i in enumerate(by_score):
+        # 質問と語彙が一致しない候補は、一次検索の順位だけで評価する
+        if scores[i] > 0:
+            fused[i] += weight / (k + rank + 1)
+    return sorted(range(first_stage_count), key=lambda i: fused[i], reverse=True)
+
+
+def rerank_lexical(
+    query: str,
+    documents: list,
+    top_n: int,
+    budget_seconds: float,
+    weight: float = 1.5,
+) -> list:
+    """
+    候補を語彙スコアで並べ替え、上位top_n件を返す。予算を超えたら一次検索の順位で返す。
+    documentsはAzure AI Searchの検索結果(chunkとtitleを含む辞書)のリスト。
+    """
+    deadline = time.monotonic() + budget_seconds
+    passages = [f'{d.get("title") or ""} {d.get("chunk") or ""}' for d in documents]
+    try:
+        scores = lexical_scores(query, passages, deadline=deadline)
+    except BudgetExceededError:
+        logger.warning(
+            "Rerank exceeded budget of %.0fms. Falling back to first-stage order",
+            budget_seconds * 1000,
+        )
+        return documents[:top_n]
+    order = fuse_ranks(len(documents), scores, weight=weight)
+    return [documents[i] for i in order[:top_n]]
+
+
+async def arerank_lexical(
+    query: str, documents: list, top_n: int, budget_seconds: float
+) -> list:
+    """
+    イベントループを止めないよう、別スレッドでリランクする。
+    スレッドの起動待ちも含めて予算を超えたら、一次検索の順位で返す。
+    """
+    try:
+        return await asyncio.wait_for(
+            asyncio.to_thread(rerank_lexical, query, documents, top_n, budget_seconds),
+            timeout=budget_seconds,
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Rerank timed out. Falling back to first-stage order")
+        return documents[:top_n]
@@ -0,0 +1,74 @@
+"""
+チャットのリクエストで指定された絞り込み条件を、Azure AI SearchのODataフィルター式にする。
+
+受け付ける条件:
+- parent_id, doc_type, header_1, header_2, header_3: 文字列、または文字列のリスト(いずれかに一致)
+- uploaded_after, uploaded_before: ISO 8601形式の日時
+"""
+
+from datetime import datetime
+from typing import Optional
+
+# インデックス作成スクリプトでfilterableにしたフィールド
+MATCH_FIELDS = ("parent_id", "doc_type", "header_1", "header_2", "header_3")
+DATE_FIELDS = {
+    "uploaded_after": ("uploaded_at", "ge"),
+    "uploaded_before": ("uploaded_at", "lt"),
+}
+
+
+def _quote(value: str) -> str:
+    """
+    ODataの文字列リテラルにする。シングルクォートは重ねてエスケープする。
+    """
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _match(field: str, value) -> str:
+    if isinstance(value, str):
+        return f"{field} eq {_quote(value)}"
+    if (
+        isinstance(value, list)
+        and value
+        and all(isinstance(v, str) and "|" not in v for v in value)
+    ):
+        # search.inは区切り文字を含む値を扱えないため、区切り文字に'|'を使い、値では禁止する
+        return f"search.in({field}, {_quote('|'.join(value))}, '|')"
+    raise ValueError(f"{field} must be a string or a non-empty list of strings")
+
+
+def _date(field: str, operator: str, name: str, value) -> str:
+    if not isinstance(value, str):
+        raise ValueError(f"{name} must be an ISO 8601 string")
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError as e:
+        raise ValueError(f"{name} must be an ISO 8601 string") from e
+    if parsed.tzinfo is None:
+        raise ValueError(f"{name} must include a time zone")
+    return f"{field} {operator} {parsed.isoformat()}"
+
+
+def build_filter(filters: Optional[dict]) -> Optional[str]:
+    """
+    絞り込み条件からフィルター式を作る。条件がない場合はNoneを返す。
+    不正な条件はValueErrorにする。
+    """
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+
+    unknown = set(filters) - set(MATCH_FIELDS) - set(DATE_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown filter: {', '.join(sorted(unknown))}")
+
+    clauses = [
+        _match(name, filters[name]) for name in MATCH_FIELDS if name in filters
+    ]
+    clauses += [
+        _date(field, operator, name, filters[name])
+        for name, (field, operator) in DATE_FIELDS.items()
+        if name in filters
+    ]
+    return " and ".join(clauses) if clauses else None
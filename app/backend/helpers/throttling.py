@@ -0,0 +1,411 @@
+"""
+Azure OpenAI呼び出しの同時実行数を適応的に制御する。
+
+チャットとインデクシングで同じTPMクォータを共有するため、プロセス内で共通のリミッターを使う。
+- AIMD: 成功時は同時実行数の上限を少しずつ増やし、429を受けたら半減させる
+- 優先度: チャットの待ちがある間、インデクシングは実行枠を取得しない
+- Retry-After: 429の応答ヘッダーで指定された時間、すべての呼び出しを待たせる
+- リトライ: 429と一時的なエラー(接続エラー、タイムアウト、408/409/5xx)は、呼び出しごとに指数バックオフでリトライする
+キューの深さやスロットリング回数はOpenTelemetryのメトリックとして公開する。
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from enum import IntEnum
+from typing import Optional
+import openai
+from opentelemetry import metrics
+from opentelemetry.metrics import CallbackOptions, Observation
+
+logger = logging.getLogger(__name__)
+logger.setLevel(level=os.environ.get("LOGLEVEL", "INFO").upper())
+
+# 期限の直前に取得した実行枠でも、呼び出しが成り立つ程度のタイムアウトは確保する
+MIN_CALL_TIMEOUT_SECONDS = 1.0
+
+
+class Priority(IntEnum):
+    """
+    呼び出しの優先度。値が小さいほど優先される。
+    """
+
+    CHAT = 0
+    INDEXING = 1
+
+
+class ThrottledError(Exception):
+    """
+    リトライしてもスロットリングが解消しない、または実行枠を待ちきれなかった場合の例外。
+    """
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def get_retry_after(error: openai.RateLimitError) -> Optional[float]:
+    """
+    429応答のヘッダーから待ち時間(秒)を取り出す。
+    Azure OpenAIはretry-after-msとretry-afterを返す。
+    """
+    headers = error.response.headers if error.response is not None else {}
+    try:
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            return float(retry_after_ms) / 1000
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            return float(retry_after)
+    except ValueError:
+        # HTTP日付形式などは解釈せず、既定のバックオフに任せる
+        pass
+    return None
+
+
+def is_transient(error: Exception) -> bool:
+    """
+    リトライで解消し得る一時的なエラーかを返す。429を除き、SDKの既定のリトライと同じ範囲とする。
+    """
+    # APITimeoutErrorはAPIConnectionErrorのサブクラス
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    return isinstance(error, openai.APIStatusError) and (
+        error.status_code in (408, 409) or error.status_code >= 500
+    )
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    優先度付きのAIMD同時実行リミッター。
+    同期呼び出しはcall、非同期呼び出しはacallを使う。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        initial_limit: float = 4,
+        min_limit: float = 1,
+        max_limit: float = 32,
+        backoff_ratio: float = 0.5,
+        max_retries: int = 5,
+        base_delay: float = 1.0,
+    ):
+        self.name = name
+        self._limit = float(initial_limit)
+        self._min_limit = float(min_limit)
+        self._max_limit = float(max_limit)
+        self._backoff_ratio = backoff_ratio
+        self._max_retries = max_retries
+        self._base_delay = base_delay
+
+        self._cond = threading.Condition()
+        # 非同期の待ちは、スレッドを使わずイベントループのFutureで起こす
+        self._async_waiters: list = []
+        self._in_flight = 0
+        self._waiting = {priority: 0 for priority in Priority}
+        self._blocked_until = 0.0
+        self._last_backoff = 0.0
+        self._throttled_total = 0
+
+        meter = metrics.get_meter(__name__)
+        attributes = {"limiter": name}
+        self._throttled_counter = meter.create_counter(
+            "aoai.limiter.throttled",
+            description="Number of 429 responses from Azure OpenAI",
+        )
+        self._attributes = attributes
+        meter.create_observable_gauge(
+            "aoai.limiter.queue_depth",
+            callbacks=[self._observe_queue_depth],
+            description="Number of calls waiting for a slot",
+        )
+        meter.create_observable_gauge(
+            "aoai.limiter.in_flight",
+            callbacks=[lambda _: [Observation(self._in_flight, attributes)]],
+            description="Number of calls in flight",
+        )
+        meter.create_observable_gauge(
+            "aoai.limiter.concurrency_limit",
+            callbacks=[lambda _: [Observation(self._limit, attributes)]],
+            description="Current concurrency limit",
+        )
+
+    def _observe_queue_depth(self, _: CallbackOptions):
+        return [
+            Observation(
+                self._waiting[priority],
+                {**self._attributes, "priority": priority.name.lower()},
+            )
+            for priority in Priority
+        ]
+
+    def _has_higher_priority_waiters(self, priority: Priority) -> bool:
+        return any(self._waiting[p] > 0 for p in Priority if p < priority)
+
+    def _try_acquire(self, priority: Priority, now: float) -> bool:
+        """
+        実行枠を取れる場合は取る。ロックを持った状態で呼ぶ。
+        """
+        if (
+            self._blocked_until - now <= 0
+            and self._in_flight < int(self._limit)
+            and not self._has_higher_priority_waiters(priority)
+        ):
+            self._in_flight += 1
+            return True
+        return False
+
+    def _wait_seconds(self, now: float, deadline: Optional[float]) -> Optional[float]:
+        """
+        次に状態を確かめるまでの待ち時間を返す。期限を過ぎていれば0を返す。
+        ロックを持った状態で呼ぶ。
+        """
+        blocked = self._blocked_until - now
+        wait = blocked if blocked > 0 else None
+        # Retry-Afterの待ちが期限を越える場合は、待たずにあきらめる
+        if deadline is not None and self._blocked_until > deadline:
+            return 0.0
+        if deadline is not None:
+            remaining = max(deadline - now, 0.0)
+            wait = remaining if wait is None else min(wait, remaining)
+        return wait
+
+    def _notify_all(self):
+        """
+        同期と非同期のすべての待ちを起こす。ロックを持った状態で呼ぶ。
+        """
+        self._cond.notify_all()
+        for loop, future in self._async_waiters:
+            loop.call_soon_threadsafe(_wake, future)
+        self._async_waiters.clear()
+
+    def acquire(self, priority: Priority, deadline: Optional[float] = None) -> bool:
+        """
+        実行枠を取得する。deadline(time.monotonicの値)までに取得できない場合はFalseを返す。
+        """
+        with self._cond:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self._try_acquire(priority, now):
+                        return True
+                    wait = self._wait_seconds(now, deadline)
+                    if wait == 0:
+                        return False
+                    self._cond.wait(wait)
+            finally:
+                self._waiting[priority] -= 1
+                # 優先度の高い待ちが減ると、低い優先度の待ちが進める場合がある
+                self._notify_all()
+
+    async def acquire_async(
+        self, priority: Priority, deadline: Optional[float] = None
+    ) -> bool:
+        """
+        acquireの非同期版。実行枠の取得はロックの中で同期的に行うため、
+        待っている間にキャンセルされても実行枠は残らない。
+        """
+        loop = asyncio.get_running_loop()
+        with self._cond:
+            self._waiting[priority] += 1
+        future = None
+        try:
+            while True:
+                with self._cond:
+                    now = time.monotonic()
+                    if self._try_acquire(priority, now):
+                        return True
+                    wait = self._wait_seconds(now, deadline)
+                    if wait == 0:
+                        return False
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+                try:
+                    await asyncio.wait_for(future, wait)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self._cond:
+                self._waiting[priority] -= 1
+                if future is not None:
+                    self._async_waiters = [
+                        w for w in self._async_waiters if w[1] is not future
+                    ]
+                self._notify_all()
+
+    def release(
+        self,
+        throttled: bool = False,
+        retry_after: Optional[float] = None,
+        failed: bool = False,
+    ):
+        """
+        実行枠を返却し、結果に応じて上限を調整する。
+        429以外で失敗した場合(failed)は、上限を変えない。
+        """
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self._throttled_total += 1
+                self._throttled_counter.add(1, self._attributes)
+                # 同じバーストで受けた複数の429で、上限を下げすぎないようにする
+                if now - self._last_backoff >= (retry_after or self._base_delay):
+                    self._limit = max(
+                        self._min_limit, self._limit * self._backoff_ratio
+                    )
+                    self._last_backoff = now
+                # すべての呼び出しを待たせるのは、サーバーがRetry-Afterを返した場合だけ
+                if retry_after:
+                    self._blocked_until = max(self._blocked_until, now + retry_after)
+                logger.warning(
+                    "Azure OpenAI throttled. limit=%.1f, retry_after=%s",
+                    self._limit,
+                    retry_after,
+                )
+            elif not failed:
+                self._limit = min(self._max_limit, self._limit + 1 / self._limit)
+            self._notify_all()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        return self._base_delay * (2**attempt) * random.uniform(0.5, 1.5)
+
+    def _handle_error(
+        self, error: Exception, attempt: int, deadline: Optional[float]
+    ) -> Optional[float]:
+        """
+        失敗した呼び出しの実行枠を返却し、リトライまでにこの呼び出しが待つ秒数を返す。
+        リトライしないエラーや、待つと期限を過ぎる一時的なエラーはNoneを返す。
+        """
+        last_attempt = attempt == self._max_retries
+        if isinstance(error, openai.RateLimitError):
+            retry_after = get_retry_after(error)
+            self.release(throttled=True, retry_after=retry_after)
+            # Retry-Afterがある場合は、実行枠の取得で全体の待ちに従う
+            if retry_after is not None or last_attempt:
+                return 0.0
+            delay = self._backoff_delay(attempt)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise ThrottledError(
+                    f"{self.name} is throttled beyond the deadline", delay
+                ) from error
+            return delay
+
+        self.release(failed=True)
+        if not is_transient(error) or last_attempt:
+            return None
+        delay = self._backoff_delay(attempt)
+        if deadline is not None and time.monotonic() + delay > deadline:
+            return None
+        logger.warning(
+            "Transient error from %s: %s. Retrying in %.1fs", self.name, error, delay
+        )
+        return delay
+
+    @staticmethod
+    def _call_timeout(deadline: float) -> float:
+        return max(deadline - time.monotonic(), MIN_CALL_TIMEOUT_SECONDS)
+
+    def _suggested_wait(self) -> float:
+        return max(self._blocked_until - time.monotonic(), self._base_delay)
+
+    def call(self, func, *args, priority: Priority, deadline=None, **kwargs):
+        """
+        同期関数を実行枠の中で呼び出す。429や一時的なエラーの場合は待ってからリトライする。
+        deadline(time.monotonicの値)はリトライを含めた全体の期限。
+        期限がある場合は、残り時間をSDKのtimeoutとして呼び出しごとに渡す。
+        """
+        last_error = None
+        for attempt in range(self._max_retries + 1):
+            if not self.acquire(priority, deadline):
+                raise ThrottledError(
+                    f"Timed out waiting for {self.name} slot", self._suggested_wait()
+                ) from last_error
+            if deadline is not None:
+                kwargs["timeout"] = self._call_timeout(deadline)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = self._handle_error(e, attempt, deadline)
+                if delay is None:
+                    raise
+                last_error = e
+                time.sleep(delay)
+                continue
+            except BaseException:
+                self.release(failed=True)
+                raise
+            self.release()
+            return result
+
+        raise ThrottledError(
+            f"{self.name} is still throttled after retries", self._suggested_wait()
+        ) from last_error
+
+    async def acall(self, func, *args, priority: Priority, deadline=None, **kwargs):
+        """
+        コルーチン関数を実行枠の中で呼び出す。429や一時的なエラーの場合は待ってからリトライする。
+        deadline(time.monotonicの値)はリトライを含めた全体の期限。
+        期限がある場合は、残り時間をSDKのtimeoutとして呼び出しごとに渡す。
+        """
+        last_error = None
+        for attempt in range(self._max_retries + 1):
+            if not await self.acquire_async(priority, deadline):
+                raise ThrottledError(
+                    f"Timed out waiting for {self.name} slot", self._suggested_wait()
+                ) from last_error
+            if deadline is not None:
+                kwargs["timeout"] = self._call_timeout(deadline)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                delay = self._handle_error(e, attempt, deadline)
+                if delay is None:
+                    raise
+                last_error = e
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                self.release(failed=True)
+                raise
+            self.release()
+            return result
+
+        raise ThrottledError(
+            f"{self.name} is still throttled after retries", self._suggested_wait()
+        ) from last_error
+
+    def stats(self) -> dict:
+        """
+        現在の状態を返す。ログや診断用。
+        """
+        with self._cond:
+            return {
+                "limit": self._limit,
+                "in_flight": self._in_flight,
+                "queue_depth": {
+                    priority.name.lower(): count
+                    for priority, count in self._waiting.items()
+                },
+                "throttled_total": self._throttled_total,
+                "blocked_for": max(self._blocked_until - time.monotonic(), 0.0),
+            }
+
+
+# チャットとインデクシングのBlueprintは同じワーカープロセスで動くため、リミッターを共有する
+aoai_limiter = AdaptiveConcurrencyLimiter(
+    "azure-openai",
+    initial_limit=float(os.getenv("AOAI_LIMITER_INITIAL_CONCURRENCY", "4")),
+    max_limit=float(os.getenv("AOAI_LIMITER_MAX_CONCURRENCY", "32")),
+    max_retries=int(os.getenv("AOAI_LIMITER_MAX_RETRIES", "5")),
+)
@@ -88,6 +88,10 @@ for message in st.session_state.messages:
 if "download" not in st.session_state:
     st.session_state.download = {}
 
+# チャットAPIが返す会話ID。以降の質問で送り、履歴を踏まえた回答を得る
+if "conversation_id" not in st.session_state:
+    st.session_state.conversation_id = None
+
 if prompt := st.chat_input("ここに質問を入力"):
     with st.chat_message("user"):
         st.write(prompt)
@@ -100,9 +104,13 @@ if prompt := st.chat_input("ここに質問を入力"):
 
     try:
         stream = requests.post(
-            chat_api_endpoint, json={"query": prompt}, stream=True, timeout=30
+            chat_api_endpoint,
+            json={"query": prompt, "conversation_id": st.session_state.conversation_id},
+            stream=True,
+            timeout=30,
         )
         stream.raise_for_status()
+        st.session_state.conversation_id = stream.headers.get("X-Conversation-Id")
         # streamに含まれるblob URL文字列を抜き出し、ダウンロードに備えたい。かつ、回答ではURLを非表示にしたい。
         # しかしStreamlitのwrite_streamを使うと、streamの終了(StopIteration)を補足できず、終了時にblob URL文字列を返せない。
         # よってstreamを順次表示せず、最後まで読み切って使う。
@@ -134,7 +142,12 @@ if prompt := st.chat_input("ここに質問を入力"):
 
     except HTTPError as e:
         logger.error("API request failed(HTTP): %s", e)
-        st.error(f"チャットAPIへの要求でHTTPエラーが起こりました: {str(e)}")
+        if e.response is not None and e.response.status_code in (429, 503):
+            st.error(
+                "チャットAPIが混み合っています。しばらくしてから再実行してください"
+            )
+        else:
+            st.error(f"チャットAPIへの要求でHTTPエラーが起こりました: {str(e)}")
     except Timeout as e:
         logger.error("API request failed(Timeout): %s", e)
         st.error(
@@ -0,0 +1,150 @@
+"""
+チャンク分割のスループットとチャンクのトークン数のばらつきを比較する。
+
+- langchain: MarkdownHeaderTextSplitterとRecursiveCharacterTextSplitterの2段階分割(従来の方式)
+- japanese: helpers.chunking.JapaneseMarkdownChunker
+
+使用方法: python benchmark_chunking.py [--file <Markdownファイル>] [--size-mb 5] [--repeat 3]
+ファイルを指定しない場合は、日本語の合成Markdownを使う。
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from langchain_text_splitters import (
+    MarkdownHeaderTextSplitter,
+    RecursiveCharacterTextSplitter,
+)
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'app', 'backend'))
+)
+
+from helpers.chunking import HEADERS_TO_SPLIT_ON, JapaneseMarkdownChunker
+
+SENTENCES = [
+    "本規程は、社内における情報資産の取り扱いについて定める。",
+    "従業員は、業務上知り得た情報を適切に管理しなければならない！",
+    "申請書は所属長の承認を得たうえで、総務部へ提出すること。",
+    "詳細は別紙「情報セキュリティ運用手順」を参照してください。",
+    "なお、例外的な取り扱いが必要な場合は事前に相談すること？",
+    "The policy applies to all employees, contractors and temporary staff.",
+    "経費精算はシステム上で行い、領収書の原本は30日間保管する。",
+]
+
+
+def generate_markdown(size_mb: float, seed: int = 0) -> str:
+    """
+    見出しと日本語の段落からなる合成Markdownを作る。
+    """
+    rng = random.Random(seed)
+    target = int(size_mb * 1024 * 1024)
+    parts = []
+    size = 0
+    chapter = 0
+    while size < target:
+        chapter += 1
+        section_parts = [f"# 第{chapter}章 規程\n\n"]
+        for section in range(1, rng.randint(2, 5)):
+            section_parts.append(f"## {chapter}.{section} 概要\n\n")
+            for sub in range(1, rng.randint(2, 4)):
+                section_parts.append(f"### {chapter}.{section}.{sub} 詳細\n\n")
+                for _ in range(rng.randint(2, 6)):
+                    paragraph = "".join(
+                        rng.choice(SENTENCES) for _ in range(rng.randint(3, 15))
+                    )
+                    section_parts.append(paragraph + "\n\n")
+        parts.extend(section_parts)
+        size += sum(len(p.encode("utf-8")) for p in section_parts)
+    return "".join(parts)
+
+
+def split_langchain(text: str, chunk_size: int, chunk_overlap: int) -> list:
+    """
+    従来の2段階分割。
+    """
+    markdown_splitter = MarkdownHeaderTextSplitter(
+        headers_to_split_on=list(HEADERS_TO_SPLIT_ON)
+    )
+    recursive_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    docs = recursive_splitter.split_documents(markdown_splitter.split_text(text))
+    return [doc.page_content for doc in docs]
+
+
+def split_japanese(chunker: JapaneseMarkdownChunker, text: str) -> list:
+    """
+    1回の走査で分割する。
+    """
+    return [chunk.content for chunk in chunker.split(text)]
+
+
+def measure(name: str, func, text: str, repeat: int, count_tokens) -> None:
+    """
+    処理時間の最良値と、チャンクのトークン数の分布を表示する。
+    """
+    elapsed = []
+    chunks = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        chunks = func(text)
+        elapsed.append(time.perf_counter() - start)
+
+    best = min(elapsed)
+    size_mb = len(text.encode("utf-8")) / 1024 / 1024
+    tokens = [count_tokens(c) for c in chunks]
+    print(
+        f"{name:10s} {best:8.3f}s {size_mb / best:8.2f}MB/s "
+        f"chunks={len(chunks):6d} "
+        f"tokens(mean={statistics.mean(tokens):7.1f}, "
+        f"stdev={statistics.pstdev(tokens):7.1f}, "
+        f"min={min(tokens):5d}, max={max(tokens):5d})"
+    )
+
+
+def main():
+    """
+    ベンチマークを実行する。
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--file", help="Markdown file to split")
+    parser.add_argument("--size-mb", type=float, default=5.0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--chunk-size", type=int, default=2000)
+    parser.add_argument("--chunk-overlap", type=int, default=100)
+    parser.add_argument("--max-tokens", type=int, default=1000)
+    parser.add_argument("--overlap-tokens", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, encoding="utf-8") as f:
+            text = f.read()
+    else:
+        text = generate_markdown(args.size_mb)
+
+    chunker = JapaneseMarkdownChunker(
+        max_tokens=args.max_tokens, overlap_tokens=args.overlap_tokens
+    )
+    print(f"input: {len(text.encode('utf-8')) / 1024 / 1024:.2f}MB, repeat={args.repeat}")
+    measure(
+        "langchain",
+        lambda t: split_langchain(t, args.chunk_size, args.chunk_overlap),
+        text,
+        args.repeat,
+        chunker.count_tokens,
+    )
+    measure(
+        "japanese",
+        lambda t: split_japanese(chunker, t),
+        text,
+        args.repeat,
+        chunker.count_tokens,
+    )
+
+
+if __name__ == "__main__":
+    main()
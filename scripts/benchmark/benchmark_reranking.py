@@ -0,0 +1,358 @@
+"""
+リランクの品質と処理時間を、一次検索の順位と比較する。
+
+評価データはJSON Lines形式で、1行に1問を書く。
+    {"query": "...", "candidates": [{"title": "...", "chunk": "..."}, ...], "relevant": [3, 17]}
+candidatesは一次検索の順位のまま並べ、relevantには正解の候補の添字を入れる。
+品質(再現率とMRR)は、実際の一次検索の順位を記録した評価データを指定した場合だけ表示する。
+relevantが空の行は、品質の集計から除く。
+ファイルを指定しない場合は、合成データでリランクの処理時間だけを測る。
+
+--liveを指定すると、評価データの質問でAzure AI Searchを検索し、候補を--candidates件取得して
+リランクするまでのエンドツーエンドの時間を、リランクしない場合(5件取得)と比較する。
+--semanticを加えると、セマンティックランカーでも検索し、時間と順位を一次検索と比較する。
+行にrelevant_chunk_ids(正解のチャンクのchunk_id)があれば、それぞれの順位の品質も表示する。
+    {"query": "...", "relevant_chunk_ids": ["file-...0"]}
+環境変数はチャットと同じものを使う。
+
+使用方法:
+    python benchmark_reranking.py [--file <評価データ>] [--top 3] [--budget-ms 200]
+    python benchmark_reranking.py --live --file <評価データ> [--candidates 50] [--semantic]
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'app', 'backend'))
+)
+
+from helpers.reranking import SEMANTIC_MIN_WAIT_MS, rerank_lexical
+
+SENTENCES = [
+    "年次有給休暇は入社6か月後に付与され、申請は勤怠システムで行う。",
+    "経費精算は発生月の翌月末までに申請し、領収書を添付すること。",
+    "出張は事前に申請し、旅費は規程の上限額の範囲で精算する。",
+    "在宅勤務は週3日までとし、始業と終業を上長に報告する。",
+    "機密情報を社外に持ち出す場合は、暗号化したうえで承認を得る。",
+    "新入社員研修は4月に実施し、修了後に配属先が決定する。",
+    "本規程は全従業員に適用され、必要に応じて改定される。",
+    "詳細は各部門の手順書を参照すること。",
+]
+QUERIES = [
+    "有給休暇の申請方法を教えてください",
+    "経費精算の期限はいつですか",
+    "在宅勤務は週に何日までできますか",
+    "機密情報を持ち出すときの手続きは",
+]
+
+
+def check_env_var(name: str) -> str:
+    """
+    環境変数が設定されているかを確認し、値を返す。
+    設定されていない場合は例外を返す。
+    """
+    value = os.getenv(name)
+    if not value:
+        raise ValueError(f"{name} is not set or empty")
+    return value
+
+
+def generate_dataset(questions: int, candidates: int, seed: int = 0) -> list:
+    """
+    処理時間の計測用に、チャンクと同程度の長さの候補を並べた合成データを作る。
+    正解や一次検索の順位は実際の検索を反映しないため、品質の評価には使わない。
+    """
+    rng = random.Random(seed)
+    dataset = []
+    for _ in range(questions):
+        items = [
+            {
+                "title": "規程.pdf",
+                "chunk": "".join(
+                    rng.choice(SENTENCES) for _ in range(rng.randint(5, 30))
+                ),
+            }
+            for _ in range(candidates)
+        ]
+        dataset.append({"query": rng.choice(QUERIES), "candidates": items})
+    return dataset
+
+
+def load_dataset(path: str) -> list:
+    """
+    評価データを読み込む。
+    """
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def evaluate(ranked_ids: list, relevant: set, top: int) -> tuple:
+    """
+    上位top件の再現率と、逆順位(MRR用)を返す。
+    正解がない場合は評価できないため、Noneを返す。
+    """
+    if not relevant:
+        return None
+    hits = len(relevant & set(ranked_ids[:top]))
+    reciprocal_rank = 0.0
+    for rank, i in enumerate(ranked_ids, start=1):
+        if i in relevant:
+            reciprocal_rank = 1 / rank
+            break
+    return hits / len(relevant), reciprocal_rank
+
+
+def format_quality(quality: dict, top: int) -> list:
+    """
+    順位の付け方ごとの再現率とMRRを、表示用の行にする。
+    """
+    return [
+        f"{name:12s} recall@{top}={statistics.mean(r for r, _ in scores):.3f} "
+        f"MRR={statistics.mean(rr for _, rr in scores):.3f}"
+        for name, scores in quality.items()
+        if scores
+    ]
+
+
+def format_latency(name: str, latencies: list, budget_ms: float = None) -> str:
+    """
+    処理時間の分布を1行の文字列にする。
+    """
+    latencies = sorted(latencies)
+    line = (
+        f"{name:22s} p50={latencies[len(latencies) // 2]:.2f}ms "
+        f"p95={latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]:.2f}ms "
+        f"max={latencies[-1]:.2f}ms"
+    )
+    if budget_ms is not None:
+        line += f" over-budget={sum(1 for t in latencies if t > budget_ms)}"
+    return line
+
+
+def run_offline(dataset: list, top: int, budget_ms: int, with_quality: bool):
+    """
+    候補を与えてリランクし、処理時間と(評価データがあれば)品質を表示する。
+    """
+    quality = {"first-stage": [], "lexical": []}
+    unjudged = 0
+    latencies = []
+    for item in dataset:
+        candidates = item["candidates"]
+        # 並べ替え後の順位を評価するため、候補に添字を持たせる
+        documents = [{**c, "_id": i} for i, c in enumerate(candidates)]
+
+        start = time.perf_counter()
+        result = rerank_lexical(
+            item["query"], documents, len(documents), budget_ms / 1000
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+
+        if not with_quality:
+            continue
+        relevant = set(item.get("relevant") or [])
+        if not relevant:
+            unjudged += 1
+            continue
+        quality["first-stage"].append(
+            evaluate(list(range(len(candidates))), relevant, top)
+        )
+        quality["lexical"].append(evaluate([d["_id"] for d in result], relevant, top))
+
+    print(f"questions={len(dataset)}, top={top}, budget={budget_ms}ms")
+    if with_quality:
+        if unjudged:
+            print(f"{unjudged} questions without relevant are excluded from quality")
+        for line in format_quality(quality, top):
+            print(line)
+    else:
+        print("quality is not reported for synthetic data. Use --file to measure it")
+    print(format_latency("rerank", latencies, budget_ms))
+
+
+def overlap(ranked_ids: list, first_stage_ids: list, top: int) -> float:
+    """
+    並べ替え後の上位top件のうち、一次検索でも上位top件だった割合を返す。
+    """
+    if not ranked_ids[:top]:
+        return 0.0
+    return len(set(ranked_ids[:top]) & set(first_stage_ids[:top])) / len(
+        ranked_ids[:top]
+    )
+
+
+def run_live(
+    dataset: list, candidates: int, top: int, budget_ms: int, semantic_options: dict
+):
+    """
+    Azure AI Searchから候補を取得してリランクするまでの時間と順位を、一次検索と比較する。
+    semantic_optionsを指定した場合は、セマンティックランカーでも検索する。
+    質問のベクトル化は、リランクの有無で変わらないため計測に含めない。
+    """
+    # pylint: disable=import-outside-toplevel
+    import openai
+    from azure.identity import DefaultAzureCredential, get_bearer_token_provider
+    from azure.search.documents import SearchClient
+    from azure.search.documents.models import VectorizedQuery
+    from helpers.load_azd_env import load_azd_env
+
+    load_azd_env()
+    credential = DefaultAzureCredential()
+    openai_client = openai.AzureOpenAI(
+        api_version=check_env_var("AZURE_OPENAI_API_VERSION"),
+        azure_endpoint=check_env_var("AZURE_OPENAI_ENDPOINT"),
+        azure_ad_token_provider=get_bearer_token_provider(
+            credential, "https://cognitiveservices.azure.com/.default"
+        ),
+    )
+    embedding_model = check_env_var("AZURE_OPENAI_EMBEDDING_MODEL")
+    search_client = SearchClient(
+        endpoint=f"https://{check_env_var('AZURE_SEARCH_SERVICE_NAME')}.search.windows.net",
+        index_name=check_env_var("AZURE_SEARCH_INDEX_NAME"),
+        credential=credential,
+    )
+
+    def fetch(query: str, vector: list, k: int, top_k: int, **options) -> list:
+        # チャットと同じハイブリッド検索。結果をすべて受け取るまでを計測する
+        return list(
+            search_client.search(
+                search_text=query,
+                vector_queries=[
+                    VectorizedQuery(
+                        kind="vector",
+                        fields="text_vector",
+                        vector=vector,
+                        k_nearest_neighbors=k,
+                    )
+                ],
+                select=["chunk_id", "title", "chunk", "url"],
+                top=top_k,
+                **options,
+            )
+        )
+
+    def timed(func, *args, **kwargs) -> tuple:
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        return result, (time.perf_counter() - start) * 1000
+
+    latencies = {"fetch top=5 (none)": [], f"fetch top={candidates}": []}
+    latencies[f"fetch+lexical top={candidates}"] = []
+    if semantic_options:
+        latencies[f"fetch semantic top={candidates}"] = []
+    orders = {"first-stage": [], "lexical": [], "semantic": []}
+    quality = {name: [] for name in orders}
+    for item in dataset:
+        query = item["query"]
+        vector = (
+            openai_client.embeddings.create(input=query, model=embedding_model)
+            .data[0]
+            .embedding
+        )
+        # 接続の確立を計測から除くため、1回目は捨てる
+        fetch(query, vector, 3, 5)
+
+        _, elapsed = timed(fetch, query, vector, 3, 5)
+        latencies["fetch top=5 (none)"].append(elapsed)
+
+        documents, fetched = timed(fetch, query, vector, candidates, candidates)
+        reranked, elapsed = timed(
+            rerank_lexical, query, documents, len(documents), budget_ms / 1000
+        )
+        latencies[f"fetch top={candidates}"].append(fetched)
+        latencies[f"fetch+lexical top={candidates}"].append(fetched + elapsed)
+        ranked = {
+            "first-stage": [d["chunk_id"] for d in documents],
+            "lexical": [d["chunk_id"] for d in reranked],
+        }
+
+        if semantic_options:
+            semantic, elapsed = timed(
+                fetch, query, vector, candidates, candidates, **semantic_options
+            )
+            latencies[f"fetch semantic top={candidates}"].append(elapsed)
+            ranked["semantic"] = [d["chunk_id"] for d in semantic]
+
+        relevant = set(item.get("relevant_chunk_ids") or [])
+        for name, ids in ranked.items():
+            orders[name].append(overlap(ids, ranked["first-stage"], top))
+            if relevant:
+                quality[name].append(evaluate(ids, relevant, top))
+
+    print(f"questions={len(dataset)}, candidates={candidates}, top={top}")
+    for name, values in latencies.items():
+        print(format_latency(name, values))
+    # 一次検索の上位がどれだけ入れ替わったか。1.0なら順位の上位は変わらない
+    for name in ("lexical", "semantic"):
+        if orders[name]:
+            print(
+                f"{name:12s} same-as-first-stage@{top}="
+                f"{statistics.mean(orders[name]):.3f}"
+            )
+    for line in format_quality(quality, top):
+        print(line)
+
+
+def main():
+    """
+    ベンチマークを実行する。
+    """
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--file", help="JSON Lines evaluation data")
+    parser.add_argument(
+        "--live", action="store_true", help="measure end-to-end latency against Azure AI Search"
+    )
+    parser.add_argument(
+        "--semantic",
+        action="store_true",
+        help="with --live, also search with the semantic ranker",
+    )
+    parser.add_argument(
+        "--semantic-max-wait-ms",
+        type=int,
+        default=int(os.getenv("SEMANTIC_MAX_WAIT_MS", str(SEMANTIC_MIN_WAIT_MS))),
+    )
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--candidates", type=int, default=50)
+    parser.add_argument("--top", type=int, default=3)
+    parser.add_argument("--budget-ms", type=int, default=200)
+    args = parser.parse_args()
+
+    if args.semantic and not args.live:
+        parser.error("--semantic requires --live")
+    if args.live:
+        if not args.file:
+            parser.error("--live requires --file")
+        semantic_options = {}
+        if args.semantic:
+            # チャットと同じ構成と待ち時間の下限を使う
+            semantic_options = {
+                "query_type": "semantic",
+                "semantic_configuration_name": os.getenv(
+                    "AZURE_SEARCH_SEMANTIC_CONFIGURATION", "default"
+                ),
+                "semantic_max_wait_in_milliseconds": max(
+                    SEMANTIC_MIN_WAIT_MS, args.semantic_max_wait_ms
+                ),
+            }
+        run_live(
+            load_dataset(args.file),
+            args.candidates,
+            args.top,
+            args.budget_ms,
+            semantic_options,
+        )
+    elif args.file:
+        run_offline(load_dataset(args.file), args.top, args.budget_ms, with_quality=True)
+    else:
+        dataset = generate_dataset(args.questions, args.candidates)
+        run_offline(dataset, args.top, args.budget_ms, with_quality=False)
+
+
+if __name__ == "__main__":
+    main()
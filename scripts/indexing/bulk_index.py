@@ -0,0 +1,451 @@
+"""
+ローカルのディレクトリ、またはAzure Blobのコンテナーにあるドキュメントを一括でインデクシングする。
+
+Blobトリガー(bp_indexing)と同じ処理(レイアウト分析、チャンク分割、ベクトル埋め込み、登録)を、
+Functionsの外で並列に実行する。
+- チャンク分割はCPUを使うため、プロセスプールで実行する
+- レイアウト分析、ベクトル埋め込み、登録は非同期I/Oで並行して実行する
+- 完了したドキュメントをチェックポイントファイルに記録し、再実行時は続きから処理する
+
+使用方法:
+    python bulk_index.py --dir <ディレクトリ> [--base-url <URL>]
+    python bulk_index.py --container <コンテナー名>
+--dirの場合、参照元のURLには同じ相対パスでコンテナーにアップロードしたBlobのURLを登録する。
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from urllib.parse import quote
+import openai
+from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
+from azure.search.documents.aio import SearchClient
+from azure.storage.blob.aio import ContainerClient
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
+from azure.ai.documentintelligence.models import AnalyzeDocumentRequest
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'app', 'backend'))
+)
+
+from helpers.indexing_pipeline import (
+    LAYOUT_MODEL_ID,
+    build_search_document,
+    create_chunker,
+    to_uploaded_at,
+)
+from helpers.load_azd_env import load_azd_env
+from helpers.throttling import Priority, aoai_limiter
+
+logging.basicConfig(
+    level=os.getenv("LOGLEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(message)s",
+)
+# Azure SDKのログが冗長なため、ログレベルをWARNにする
+# https://github.com/Azure/azure-sdk-for-python/issues/9422
+logging.getLogger("azure").setLevel(os.environ.get("LOGLEVEL_AZURE", "WARN").upper())
+logger = logging.getLogger(__name__)
+
+# admin/app.pyでアップロードできるファイルの種類
+SUPPORTED_EXTENSIONS = {".pdf", ".docx", ".xlsx", ".pptx", ".html"}
+EMBEDDING_BATCH_SIZE = 16
+UPLOAD_BATCH_SIZE = 50
+
+
+def check_env_var(name: str) -> str:
+    """
+    環境変数が設定されているかを確認し、値を返す。
+    設定されていない場合は例外を返す。
+    """
+    value = os.getenv(name)
+    if not value:
+        raise ValueError(f"{name} is not set or empty")
+    return value
+
+
+def positive_int(value: str) -> int:
+    """
+    引数を正の整数として解釈する。
+    """
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {value}")
+    return number
+
+
+@functools.lru_cache(maxsize=None)
+def _get_chunker():
+    """
+    プロセスごとに1つのチャンカーを返す。
+    """
+    return create_chunker()
+
+
+def _init_worker():
+    """
+    プロセスプールのワーカーで、チャンカー(トークナイザー)を1回だけ読み込む。
+    """
+    _get_chunker().count_tokens("")
+
+
+def _split(content: str) -> list:
+    """
+    ワーカーでチャンクに分割する。
+    """
+    return list(_get_chunker().split(content))
+
+
+class Checkpoint:
+    """
+    完了したドキュメントをJSON Linesで記録する。
+    ファイルの更新日時やETagが変わったドキュメントは、完了していないものとして扱う。
+    書き込み中に中断された行は読み飛ばし、そのドキュメントは再度処理する。
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._done = set()
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for number, line in enumerate(f, start=1):
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                        self._done.add((entry["name"], entry["version"]))
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning(
+                            "Skipping malformed checkpoint line %d in %s", number, path
+                        )
+        self._file = open(path, "a", encoding="utf-8")  # pylint: disable=consider-using-with
+        # 中断された行に続けて書き込まないよう、改行で終わっていなければ改行を補う
+        if self._file.tell() > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self._file.write("\n")
+
+    def is_done(self, name: str, version: str) -> bool:
+        """
+        完了済みかを返す。
+        """
+        return (name, version) in self._done
+
+    def mark_done(self, name: str, version: str, chunks: int):
+        """
+        完了を記録する。中断に備え、1件ごとに書き出す。
+        """
+        self._done.add((name, version))
+        self._file.write(
+            json.dumps(
+                {"name": name, "version": version, "chunks": chunks},
+                ensure_ascii=False,
+            )
+            + "\n"
+        )
+        self._file.flush()
+
+    def close(self):
+        """
+        ファイルを閉じる。
+        """
+        self._file.close()
+
+
+class LocalSource:
+    """
+    ローカルのディレクトリからドキュメントを読む。
+    名前はBlobトリガーに合わせて"<コンテナー名>/<相対パス>"とし、同じドキュメントを同じキーで登録する。
+    URLは、チャットの画面から参照元をダウンロードできるよう、アップロード先のBlobのURLとする。
+    """
+
+    def __init__(self, directory: str, container_name: str, base_url: str):
+        self._directory = Path(directory)
+        self._container_name = container_name
+        self._base_url = base_url.rstrip("/")
+
+    async def iter_documents(self):
+        """
+        (名前, URL, バージョン, 更新日時, 読み込み関数)を順に返す。
+        """
+        for path in sorted(self._directory.rglob("*")):
+            if not path.is_file() or path.suffix.lower() not in SUPPORTED_EXTENSIONS:
+                continue
+            relative = path.relative_to(self._directory).as_posix()
+            url = f"{self._base_url}/{quote(relative)}"
+            stat = path.stat()
+
+            async def read(path=path):
+                return await asyncio.to_thread(path.read_bytes)
+
+            yield (
+                f"{self._container_name}/{relative}",
+                url,
+                f"{stat.st_size}-{stat.st_mtime_ns}",
+                to_uploaded_at(datetime.fromtimestamp(stat.st_mtime, timezone.utc)),
+                read,
+            )
+
+    async def close(self):
+        """
+        閉じるものはない。
+        """
+
+
+class BlobSource:
+    """
+    Azure Blobのコンテナーからドキュメントを読む。
+    """
+
+    def __init__(self, container_name: str, credential):
+        account_name = check_env_var("AZURE_STORAGE_ACCOUNT_NAME")
+        self._container_name = container_name
+        self._client = ContainerClient(
+            account_url=f"https://{account_name}.blob.core.windows.net/",
+            container_name=container_name,
+            credential=credential,
+        )
+
+    async def iter_documents(self):
+        """
+        (名前, URL, バージョン, 更新日時, 読み込み関数)を順に返す。
+        """
+        async for blob in self._client.list_blobs():
+            if os.path.splitext(blob.name)[1].lower() not in SUPPORTED_EXTENSIONS:
+                continue
+            blob_client = self._client.get_blob_client(blob.name)
+
+            async def read(blob_client=blob_client):
+                stream = await blob_client.download_blob()
+                return await stream.readall()
+
+            yield (
+                f"{self._container_name}/{blob.name}",
+                blob_client.url,
+                blob.etag,
+                to_uploaded_at(blob.last_modified),
+                read,
+            )
+
+    async def close(self):
+        """
+        クライアントを閉じる。
+        """
+        await self._client.close()
+
+
+class BulkIndexer:
+    """
+    ドキュメントごとに、分析、分割、埋め込み、登録を行う。
+    """
+
+    def __init__(self, credential, pool: ProcessPoolExecutor):
+        self._pool = pool
+        self._embedding_model = check_env_var("AZURE_OPENAI_EMBEDDING_MODEL")
+        search_service_name = check_env_var("AZURE_SEARCH_SERVICE_NAME")
+
+        self._doc_intelligence_client = DocumentIntelligenceClient(
+            endpoint=check_env_var("AZURE_DOC_INTELLIGENCE_ENDPOINT"),
+            credential=credential,
+        )
+        # 429と一時的なエラーのリトライはリミッターに任せるため、SDKのリトライは無効にする
+        self._openai_client = openai.AsyncAzureOpenAI(
+            api_version=check_env_var("AZURE_OPENAI_API_VERSION"),
+            azure_endpoint=check_env_var("AZURE_OPENAI_ENDPOINT"),
+            azure_ad_token_provider=get_bearer_token_provider(
+                credential, "https://cognitiveservices.azure.com/.default"
+            ),
+            max_retries=0,
+        )
+        self._search_client = SearchClient(
+            endpoint=f"https://{search_service_name}.search.windows.net",
+            index_name=check_env_var("AZURE_SEARCH_INDEX_NAME"),
+            credential=credential,
+        )
+
+    async def _analyze(self, content: bytes) -> str:
+        poller = await self._doc_intelligence_client.begin_analyze_document(
+            LAYOUT_MODEL_ID, AnalyzeDocumentRequest(bytes_source=content)
+        )
+        result = await poller.result()
+        return result.content
+
+    async def _embed(self, chunks: list) -> list:
+        """
+        複数のチャンクをまとめて埋め込み、呼び出し回数を減らす。
+        """
+        embeddings = []
+        for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+            batch = chunks[start : start + EMBEDDING_BATCH_SIZE]
+            response = await aoai_limiter.acall(
+                self._openai_client.embeddings.create,
+                input=[chunk.content for chunk in batch],
+                model=self._embedding_model,
+                priority=Priority.INDEXING,
+            )
+            embeddings.extend(
+                data.embedding for data in sorted(response.data, key=lambda d: d.index)
+            )
+        return embeddings
+
+    async def _upload(self, documents: list):
+        for start in range(0, len(documents), UPLOAD_BATCH_SIZE):
+            results = await self._search_client.upload_documents(
+                documents=documents[start : start + UPLOAD_BATCH_SIZE]
+            )
+            failed = [r for r in results if not r.succeeded]
+            if failed:
+                raise RuntimeError(
+                    f"Failed to index {len(failed)} chunks: {failed[0].error_message}"
+                )
+
+    async def index(self, name: str, url: str, uploaded_at: str, read) -> int:
+        """
+        1件のドキュメントをインデクシングし、チャンク数を返す。
+        """
+        content = await read()
+        markdown = await self._analyze(content)
+        loop = asyncio.get_running_loop()
+        chunks = await loop.run_in_executor(self._pool, _split, markdown)
+        embeddings = await self._embed(chunks)
+        documents = [
+            build_search_document(name, url, i, chunk, embedding, uploaded_at)
+            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+        ]
+        await self._upload(documents)
+        return len(chunks)
+
+    async def close(self):
+        """
+        クライアントを閉じる。
+        """
+        await self._doc_intelligence_client.close()
+        await self._openai_client.close()
+        await self._search_client.close()
+
+
+async def run(args) -> int:
+    """
+    一括インデクシングを実行し、失敗したドキュメント数を返す。
+    """
+    load_azd_env()
+    container_name = args.container or check_env_var("RAG_BLOB_CONTAINER_NAME")
+
+    credential = DefaultAzureCredential()
+    checkpoint = Checkpoint(args.checkpoint)
+    if args.dir:
+        # 既定では、同じ相対パスでコンテナーにアップロードしたBlobのURLとする
+        base_url = args.base_url or (
+            f"https://{check_env_var('AZURE_STORAGE_ACCOUNT_NAME')}"
+            f".blob.core.windows.net/{container_name}"
+        )
+        source = LocalSource(args.dir, container_name, base_url)
+    else:
+        source = BlobSource(container_name, credential)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    stats = {"documents": 0, "chunks": 0, "skipped": 0, "failed": 0}
+    started = time.monotonic()
+
+    def report():
+        elapsed = time.monotonic() - started
+        logger.info(
+            "documents=%d chunks=%d skipped=%d failed=%d elapsed=%.1fs "
+            "%.2f documents/sec %.1f chunks/sec",
+            stats["documents"],
+            stats["chunks"],
+            stats["skipped"],
+            stats["failed"],
+            elapsed,
+            stats["documents"] / elapsed if elapsed else 0,
+            stats["chunks"] / elapsed if elapsed else 0,
+        )
+
+    async def process(indexer, name, url, version, uploaded_at, read):
+        try:
+            chunks = await indexer.index(name, url, uploaded_at, read)
+            checkpoint.mark_done(name, version, chunks)
+            stats["documents"] += 1
+            stats["chunks"] += chunks
+            if stats["documents"] % args.report_every == 0:
+                report()
+        except Exception as e:
+            stats["failed"] += 1
+            logger.error("Failed to index %s: %s", name, e)
+        finally:
+            semaphore.release()
+
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=_init_worker
+    ) as pool:
+        indexer = BulkIndexer(credential, pool)
+        tasks = set()
+        try:
+            async for name, url, version, uploaded_at, read in source.iter_documents():
+                if checkpoint.is_done(name, version):
+                    stats["skipped"] += 1
+                    continue
+                # 同時に処理するドキュメント数を制限し、メモリの使用量を抑える
+                await semaphore.acquire()
+                task = asyncio.create_task(
+                    process(indexer, name, url, version, uploaded_at, read)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            await asyncio.gather(*tasks)
+        finally:
+            await indexer.close()
+            await source.close()
+            await credential.close()
+            checkpoint.close()
+
+    report()
+    return stats["failed"]
+
+
+def main():
+    """
+    引数を解釈して実行する。失敗したドキュメントがあれば終了コード1を返す。
+    """
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--dir", help="local directory to index")
+    source.add_argument(
+        "--container",
+        help="Azure Blob container to index (account: AZURE_STORAGE_ACCOUNT_NAME)",
+    )
+    parser.add_argument(
+        "--base-url",
+        help="URL prefix stored for files in --dir "
+        "(default: the container URL in AZURE_STORAGE_ACCOUNT_NAME)",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        default=".bulk_index_checkpoint.jsonl",
+        help="checkpoint file for resuming",
+    )
+    parser.add_argument(
+        "--concurrency", type=positive_int, default=8, help="documents processed concurrently"
+    )
+    parser.add_argument(
+        "--workers", type=positive_int, default=os.cpu_count(), help="processes for splitting"
+    )
+    parser.add_argument("--report-every", type=positive_int, default=10)
+    args = parser.parse_args()
+
+    failed = asyncio.run(run(args))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,10 @@ from azure.search.documents.indexes.models import (
     HnswAlgorithmConfiguration,
     VectorSearchProfile,
     SearchIndex,
+    SemanticConfiguration,
+    SemanticField,
+    SemanticPrioritizedFields,
+    SemanticSearch,
 )
 
 sys.path.append(
@@ -46,7 +50,12 @@ credential = DefaultAzureCredential()
 index_client = SearchIndexClient(endpoint=search_endpoint, credential=credential)
 
 fields = [
-    SearchField(name="parent_id", type=SearchFieldDataType.String),
+    SearchField(
+        name="parent_id",
+        type=SearchFieldDataType.String,
+        filterable=True,
+        analyzer_name="keyword",
+    ),
     SearchField(
         name="title", type=SearchFieldDataType.String, analyzer_name="ja.microsoft"
     ),
@@ -68,6 +77,38 @@ fields = [
         facetable=False,
         analyzer_name="ja.microsoft",
     ),
+    SearchField(
+        name="header_1",
+        type=SearchFieldDataType.String,
+        filterable=True,
+        analyzer_name="ja.microsoft",
+    ),
+    SearchField(
+        name="header_2",
+        type=SearchFieldDataType.String,
+        filterable=True,
+        analyzer_name="ja.microsoft",
+    ),
+    SearchField(
+        name="header_3",
+        type=SearchFieldDataType.String,
+        filterable=True,
+        analyzer_name="ja.microsoft",
+    ),
+    SearchField(
+        name="doc_type",
+        type=SearchFieldDataType.String,
+        searchable=False,
+        filterable=True,
+        facetable=True,
+    ),
+    SearchField(
+        name="uploaded_at",
+        type=SearchFieldDataType.DateTimeOffset,
+        searchable=False,
+        filterable=True,
+        sortable=True,
+    ),
     SearchField(
         name="text_vector",
         type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
@@ -93,6 +134,32 @@ vector_search = VectorSearch(
     ],
 )
 
-index = SearchIndex(name=search_index_name, fields=fields, vector_search=vector_search)
+# チャットのリランクでセマンティックランカーを使う場合の構成。使うにはBasic以上の価格レベルが必要。
+# infra/main.bicepのsemanticSearchで検索サービスのセマンティックランカーを有効にする(既定値はfree)。
+# 既存の検索サービスでは、ポータルの「セマンティックランカー」でプランを選ぶか、
+# az search service update --semantic-search free|standard で有効にする
+semantic_search = SemanticSearch(
+    configurations=[
+        SemanticConfiguration(
+            name="default",
+            prioritized_fields=SemanticPrioritizedFields(
+                title_field=SemanticField(field_name="title"),
+                content_fields=[SemanticField(field_name="chunk")],
+                keywords_fields=[
+                    SemanticField(field_name="header_1"),
+                    SemanticField(field_name="header_2"),
+                    SemanticField(field_name="header_3"),
+                ],
+            ),
+        )
+    ]
+)
+
+index = SearchIndex(
+    name=search_index_name,
+    fields=fields,
+    vector_search=vector_search,
+    semantic_search=semantic_search,
+)
 result = index_client.create_or_update_index(index)
 print(f"{result.name} created")